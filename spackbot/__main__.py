@@ -3,7 +3,10 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import asyncio
 import os
+import re
+import time
 
 import aiohttp
 from aiohttp import web
@@ -26,12 +29,36 @@ INSTALLATION_TOKEN_URL = "app/installations/{installation_id}/access_tokens"
 WEBHOOK_SECRET = os.environ.get("GITHUB_WEBHOOK_SECRET")
 REQUESTER = os.environ.get("GITHUB_APP_REQUESTER")
 
+#: Largest webhook payload we accept (aiohttp's default client_max_size)
+MAX_PAYLOAD_SIZE = 1024**2
+
+#: Well-formed webhook signature headers, as checked by gidgethub
+SIGNATURE_HEADERS = {
+    "X-Hub-Signature-256": re.compile(r"sha256=[0-9a-fA-F]{64}"),
+    "X-Hub-Signature": re.compile(r"sha1=[0-9a-fA-F]{40}"),
+}
+
+#: Webhook events waiting to be dispatched before we start refusing new ones
+EVENT_QUEUE_SIZE = int(os.environ.get("SPACKBOT_EVENT_QUEUE_SIZE", "100"))
+
+#: Number of events dispatched concurrently
+EVENT_WORKERS = int(os.environ.get("SPACKBOT_EVENT_WORKERS", "8"))
+
+#: Seconds the shared client session reuses a DNS lookup (aiohttp's default is 10)
+DNS_CACHE_TTL = 300
+
 routes = web.RouteTableDef()
 
 
 @routes.post("/")
 async def main(request):
     """Main entrypoint for all routes"""
+    # Refuse oversized or unsigned payloads before reading and hashing them
+    if request.content_length and request.content_length > MAX_PAYLOAD_SIZE:
+        return web.Response(status=413)
+    if WEBHOOK_SECRET and not has_valid_signature_header(request.headers):
+        return web.Response(status=400)
+
     # read the GitHub webhook payload
     body = await request.read()
 
@@ -41,25 +68,102 @@ async def main(request):
 
     # get an installation token to make a GitHubAPI for API calls
     installation_id = event.data["installation"]["id"]
-    token = await authenticate_installation(installation_id)
+    session = request.app["session"]
+    token = await authenticate_installation(installation_id, session)
+
+    # Hand the event off to the workers so GitHub gets its response right away
+    # instead of waiting (and possibly retrying) while handlers run.
+    try:
+        request.app["events"].put_nowait((event, token, time.monotonic()))
+    except asyncio.QueueFull:
+        logger.error(f"Event queue full, dropping event {event.delivery_id}")
+        return web.Response(status=503)
+
+    # return a "Success"
+    return web.Response(status=200)
+
+
+def has_valid_signature_header(headers):
+    """Check that the request carries a well-formed webhook signature.
+
+    The signature itself is verified by gidgethub once the body is read.
+    """
+    for header, regex in SIGNATURE_HEADERS.items():
+        if header in headers:
+            return bool(regex.fullmatch(headers[header]))
+    return False
 
-    dispatch_kwargs = {
-        "token": token,
-    }
 
-    async with aiohttp.ClientSession() as session:
+async def dispatch_events(app):
+    """Dispatch queued webhook events, one at a time, until cancelled"""
+    events = app["events"]
+    session = app["session"]
+
+    while True:
+        event, token, received = await events.get()
+        logger.debug(
+            f"Dispatching event {event.delivery_id} after "
+            f"{time.monotonic() - received:.2f}s in queue, "
+            f"{events.qsize()} events still queued"
+        )
+
+        dispatch_kwargs = {
+            "token": token,
+        }
+
         gh = gh_aiohttp.GitHubAPI(session, REQUESTER, oauth_token=token)
 
         # call the appropriate callback for the event
-        await router.dispatch(event, gh, session=session, **dispatch_kwargs)
+        try:
+            await router.dispatch(event, gh, session=session, **dispatch_kwargs)
+        except Exception:
+            logger.exception(f"Error handling event {event.delivery_id}")
+        finally:
+            events.task_done()
 
-    # return a "Success"
-    return web.Response(status=200)
+        logger.debug(
+            f"Handled event {event.delivery_id} in "
+            f"{time.monotonic() - received:.2f}s"
+        )
+
+
+async def create_session(app):
+    """Create one client session (and connection pool) shared by all requests"""
+    # Don't let cookies from one installation leak into requests for another.
+    # We only talk to a few hosts, so keep their DNS lookups for a while.
+    app["session"] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(ttl_dns_cache=DNS_CACHE_TTL),
+        cookie_jar=aiohttp.DummyCookieJar(),
+    )
+
+
+async def close_session(app):
+    """Close the shared client session on shutdown"""
+    await app["session"].close()
+
+
+async def start_workers(app):
+    """Create the event queue and the workers that drain it"""
+    app["events"] = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+    app["workers"] = [
+        asyncio.create_task(dispatch_events(app)) for _ in range(EVENT_WORKERS)
+    ]
+
+
+async def stop_workers(app):
+    """Cancel the event workers on shutdown"""
+    for worker in app["workers"]:
+        worker.cancel()
+    await asyncio.gather(*app["workers"], return_exceptions=True)
 
 
 if __name__ == "__main__":
-    app = web.Application()
+    app = web.Application(client_max_size=MAX_PAYLOAD_SIZE)
     app.add_routes(routes)
+    app.on_startup.append(create_session)
+    app.on_startup.append(start_workers)
+    app.on_cleanup.append(stop_workers)
+    app.on_cleanup.append(close_session)
     port = os.environ.get("PORT") or None
     if port:
         port = int(port)
@@ -3,13 +3,15 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import asyncio
+import calendar
 import os
 import re
 import time
 
-import aiohttp
-import gidgethub.apps as gha
+import jwt
 from aiohttp import web
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from dotenv import load_dotenv
 from gidgethub import aiohttp as gh_aiohttp
 
@@ -24,26 +26,90 @@ PRIVATE_KEY = os.environ.get("GITHUB_PRIVATE_KEY")
 APP_IDENTIFIER = os.environ.get("GITHUB_APP_IDENTIFIER")
 REQUESTER = os.environ.get("GITHUB_APP_REQUESTER")
 
+#: Lifetime of the JWTs we sign. GitHub rejects anything valid for more than
+#: 10 minutes, so stay a minute under to allow for clock drift.
+GITHUB_APP_JWT_EXPIRY = 9 * 60
+
+#: Runs of backslashes, as produced by Docker double-escaping the private key
+_backslashes_re = re.compile(r"\\+")
+
+#: PRIVATE_KEY parsed into a key object, so it is not re-parsed on every sign
+_signing_key = None
+
 routes = web.RouteTableDef()
 
 
 class TokenCache:
     """
     Cache for web tokens with an expiration.
+
+    At most ``max_size`` tokens are kept. When the cache is full, expired
+    tokens are dropped first, then the least recently renewed ones.
     """
 
-    def __init__(self):
-        # token name to (expiration, token) tuple
+    def __init__(self, max_size=4096):
+        # token name to (expiration, token) tuple, oldest renewal first
         self._tokens = {}
 
-    async def get_token(self, name, renew, *, time_needed=60):
-        """Get a cached token, or renew as needed."""
+        # token name to lock held while that token is being renewed
+        self._locks = {}
+
+        self.max_size = max_size
+
+    def _cached(self, name, time_needed):
+        """Return the cached token if it is valid for long enough, else None."""
         expires, token = self._tokens.get(name, (0, ""))
+        if expires < time.time() + time_needed:
+            return None
+        return token
+
+    def _store(self, name, expires, token):
+        """Store a renewed token, making room for it if needed."""
+        # Re-insert so dict order stays oldest renewal first
+        self._tokens.pop(name, None)
+
+        if len(self._tokens) >= self.max_size:
+            self.cleanup()
+        while len(self._tokens) >= self.max_size:
+            oldest = next(iter(self._tokens))
+            del self._tokens[oldest]
+            self._drop_lock(oldest)
+
+        self._tokens[name] = (expires, token)
 
+    def _drop_lock(self, name):
+        """Forget the renewal lock for a token, unless a renewal holds it."""
+        lock = self._locks.get(name)
+        if lock and not lock.locked():
+            del self._locks[name]
+
+    def cleanup(self):
+        """Remove all expired tokens from the cache."""
         now = time.time()
-        if expires < now + time_needed:
-            expires, token = await renew()
-            self._tokens[name] = (expires, token)
+        expired = [
+            name for name, (expires, _) in self._tokens.items() if expires <= now
+        ]
+        for name in expired:
+            del self._tokens[name]
+            self._drop_lock(name)
+
+    async def get_token(self, name, renew, *, time_needed=60):
+        """Get a cached token, or renew as needed.
+
+        Only one renewal per token name is in flight at a time; concurrent
+        callers wait for it and then use the renewed token.
+        """
+        token = self._cached(name, time_needed)
+        if token is not None:
+            return token
+
+        # setdefault is atomic here since there is no await in between
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            # Another caller may have renewed while we waited for the lock
+            token = self._cached(name, time_needed)
+            if token is None:
+                expires, token = await renew()
+                self._store(name, expires, token)
 
         return token
 
@@ -56,7 +122,19 @@ def parse_isotime(timestr):
     """Convert UTC ISO 8601 time stamp to seconds in epoch"""
     if timestr[-1] != "Z":
         raise ValueError(f"Time String '{timestr}' not in UTC")
-    return int(time.mktime(time.strptime(timestr[:-1], "%Y-%m-%dT%H:%M:%S")))
+
+    # GitHub always uses YYYY-MM-DDTHH:MM:SSZ, so slice out the fields directly.
+    # timegm (unlike mktime) treats the fields as UTC, matching time.time().
+    return calendar.timegm(
+        (
+            int(timestr[0:4]),
+            int(timestr[5:7]),
+            int(timestr[8:10]),
+            int(timestr[11:13]),
+            int(timestr[14:16]),
+            int(timestr[17:19]),
+        )
+    )
 
 
 async def get_jwt():
@@ -64,43 +142,43 @@ async def get_jwt():
 
     async def renew_jwt():
         # GitHub requires that you create a JWT signed with the application's
-        # private key. You need the app id and the private key, and you can
-        # use this gidgethub method to create the JWT.
-        now = time.time()
-        jwt = gha.get_jwt(app_id=APP_IDENTIFIER, private_key=PRIVATE_KEY)
-
-        # gidgethub JWT's expire after 10 minutes (you cannot change it)
-        return (now + 10 * 60), jwt
+        # private key. This is the same payload gidgethub's get_jwt builds,
+        # but signed with the key we already parsed.
+        now = int(time.time())
+        expires = now + GITHUB_APP_JWT_EXPIRY
+        payload = {"iat": now, "exp": expires, "iss": APP_IDENTIFIER}
+        token = jwt.encode(payload, _signing_key, algorithm="RS256")
+        return expires, token
 
     return await _tokens.get_token("JWT", renew_jwt)
 
 
-async def authenticate_installation(installation_id):
+async def authenticate_installation(installation_id, session):
     """Get an installation access token for the application.
 
     Renew the JWT if necessary, then use it to get an installation access
-    token from github, if necessary.
+    token from github, if necessary. ``session`` is the shared
+    ``aiohttp.ClientSession`` used for the request.
 
     """
 
     async def renew_installation_token():
-        async with aiohttp.ClientSession() as session:
-            gh = gh_aiohttp.GitHubAPI(session, REQUESTER)
-
-            # Use the JWT to get a limited-life OAuth token for a particular
-            # installation of the app. Note that we get a JWT only when
-            # necessary -- when we need to renew the installation token.
-            result = await gh.post(
-                INSTALLATION_TOKEN_URL,
-                {"installation_id": installation_id},
-                data=b"",
-                accept="application/vnd.github.machine-man-preview+json",
-                jwt=await get_jwt(),
-            )
-
-            expires = parse_isotime(result["expires_at"])
-            token = result["token"]
-            return (expires, token)
+        gh = gh_aiohttp.GitHubAPI(session, REQUESTER)
+
+        # Use the JWT to get a limited-life OAuth token for a particular
+        # installation of the app. Note that we get a JWT only when
+        # necessary -- when we need to renew the installation token.
+        result = await gh.post(
+            INSTALLATION_TOKEN_URL,
+            {"installation_id": installation_id},
+            data=b"",
+            accept="application/vnd.github.machine-man-preview+json",
+            jwt=await get_jwt(),
+        )
+
+        expires = parse_isotime(result["expires_at"])
+        token = result["token"]
+        return (expires, token)
 
     return await _tokens.get_token(installation_id, renew_installation_token)
 
@@ -120,10 +198,19 @@ def fix_private_key():
             PRIVATE_KEY = handle.read()
 
     if PRIVATE_KEY:
-        PRIVATE_KEY = re.sub(r"\\+", r"\\", PRIVATE_KEY)
-        PRIVATE_KEY = re.sub(r"\\n", r"\n", PRIVATE_KEY)
+        PRIVATE_KEY = _backslashes_re.sub(r"\\", PRIVATE_KEY)
+        PRIVATE_KEY = PRIVATE_KEY.replace("\\n", "\n")
         PRIVATE_KEY = PRIVATE_KEY.strip("'\"")
 
 
-# Fix private key ONCE on app init
+def load_signing_key():
+    """Parse PRIVATE_KEY once, so signing a JWT doesn't have to."""
+    global _signing_key
+
+    if PRIVATE_KEY:
+        _signing_key = load_pem_private_key(PRIVATE_KEY.encode(), password=None)
+
+
+# Fix and parse private key ONCE on app init
 fix_private_key()
+load_signing_key()
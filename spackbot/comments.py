@@ -3,19 +3,22 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
-import io
 import random
 import traceback
 import spackbot.helpers as helpers
 
 
-async def tell_joke(gh):
+async def tell_joke(session=None):
     """
-    Tell a joke to ease the PR tension!
+    Tell a joke to ease the PR tension! Uses ``session`` if given, otherwise
+    creates a new session for a one-off request.
     """
+    # Don't provide endpoint with credentials!
     try:
-        joke = await gh.getitem(
-            "https://official-joke-api.appspot.com/jokes/programming/random"
+        joke = await helpers.get(
+            "https://official-joke-api.appspot.com/jokes/programming/random",
+            {},
+            session,
         )
     except Exception:
         return "To be honest, I haven't heard any good jokes lately."
@@ -40,22 +43,20 @@ def say_hello():
     return random.choice(messages)
 
 
-def get_style_message(output):
-    """
-    Given a terminal output, wrap in a message
-    """
-    # The output is limited to what GitHub can store in comments, 65,536 4-byte unicode
-    # total rounded down -300 for text below
-    if len(output) >= 64700:
-        output = output[:64682] + "\n... truncated ..."
+#: GitHub comments hold 65,536 4-byte unicode characters; leave room for the text
+#: around the style output.
+style_output_limit = 64700
+style_truncated_length = 64682
 
-    return f"""
+style_output_header = """
 I was able to run `spack style --fix` for you!
 <details>
 <summary><b>spack style --fix</b></summary>
 
 ```bash
-{output}
+"""
+
+style_output_footer = """
 ```
 </details>
 Keep in mind that I cannot fix your flake8 or mypy errors, so if you have any you'll need to fix them and update the pull request.
@@ -63,16 +64,30 @@ If I was able to push to your branch, if you make further changes you will need
 """
 
 
+def get_style_message(output):
+    """
+    Given a terminal output, wrap in a message
+    """
+    if len(output) >= style_output_limit:
+        return "".join(
+            (
+                style_output_header,
+                output[:style_truncated_length],
+                "\n... truncated ...",
+                style_output_footer,
+            )
+        )
+
+    return "".join((style_output_header, output, style_output_footer))
+
+
 def format_error_message(msg, e_type, e_value, tb):
     """
     Given job failure details, format an error message to post.  The
     parameters e_type, e_value, and tb (for traceback) should be the same as
     returned by sys.exc_info().
     """
-    buffer = io.StringIO()
-    traceback.print_tb(tb, file=buffer)
-    tb_contents = buffer.getvalue()
-    buffer.close()
+    tb_contents = "".join(traceback.format_tb(tb))
 
     return f"""
 {msg}
@@ -80,7 +95,7 @@ def format_error_message(msg, e_type, e_value, tb):
 <summary><b>Details</b></summary>
 
 ```bash
-Error: {e_type}, {e_value}
+Error: {e_type.__name__}, {e_value}
 Stack trace:
 {tb_contents}
 ```
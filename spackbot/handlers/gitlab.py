@@ -58,7 +58,7 @@ async def run_pipeline(event, gh, **kwargs):
     logger.info(f"Run pipeline job enqueued: {scheduled_job.id}")
 
 
-async def close_pr_gitlab_branch(event, gh):
+async def close_pr_gitlab_branch(event, gh, session=None):
     payload = event.data
 
     pr_number = payload["number"]
@@ -71,4 +71,4 @@ async def close_pr_gitlab_branch(event, gh):
     GITLAB_TOKEN = os.environ.get("GITLAB_TOKEN")
     headers = {"PRIVATE-TOKEN": GITLAB_TOKEN}
 
-    await helpers.delete(url, headers=headers)
+    await helpers.delete(url, headers=headers, session=session)
@@ -3,10 +3,17 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import logging
 import re
 
 import spackbot.helpers as helpers
 
+try:
+    # google-re2 can match many patterns at once, in linear time
+    import re2
+except ImportError:
+    re2 = None
+
 logger = helpers.get_logger(__name__)
 
 
@@ -72,6 +79,7 @@ label_patterns = {
     #
     # Core spack
     #
+    # re2 doesn't support lookaheads, so this one is always matched with re
     "core": {"filename": r"^(?!var)"},
     "architecture": {
         "filename": r"^lib/spack/spack/(architecture|operating_systems|platforms)"
@@ -133,6 +141,66 @@ for label, pattern_dict in label_patterns.items():
         pattern_dict[attr] = [re.compile(s) for s in patterns]
 
 
+def attr_matcher(patterns):
+    """
+    Return a function that takes an attribute value and returns the indices of
+    all patterns that match it. With re2, the patterns it supports are matched
+    in a single pass with an re2.Set; the rest are searched for one by one.
+    """
+    matcher = None
+    if re2:
+        options = re2.Options()
+        options.log_errors = False
+        matcher = re2.Set.SearchSet(options)
+
+    in_set = []
+    searched = []
+    for i, pattern in enumerate(patterns):
+        if matcher is not None:
+            try:
+                matcher.Add(pattern)
+                in_set.append(i)
+                continue
+            except re2.error:
+                logger.debug(f"re2 can't compile {pattern}, using re")
+        searched.append((i, re.compile(pattern)))
+
+    if in_set:
+        matcher.Compile()
+
+    def match(value):
+        indices = [in_set[i] for i in matcher.Match(value) or ()] if in_set else []
+        indices.extend(i for i, p in searched if p.search(value))
+        return indices
+
+    return match
+
+
+#: ``attr_matchers`` maps each file attribute used in ``label_patterns`` to a
+#: function finding all of the patterns (for any label) that match it.
+#: ``label_requirements`` holds ``(label, ((attr, indices), ...))`` tuples, where
+#: ``indices`` are the label's patterns for ``attr`` in that attribute's matcher.
+_attr_patterns = {}
+label_requirements = []
+for label, pattern_dict in label_patterns.items():
+    requirements = []
+    for attr, patterns in pattern_dict.items():
+        attr_patterns = _attr_patterns.setdefault(attr, [])
+        for p in patterns:
+            if p.pattern not in attr_patterns:
+                attr_patterns.append(p.pattern)
+        indices = frozenset(attr_patterns.index(p.pattern) for p in patterns)
+        requirements.append((attr, indices))
+    label_requirements.append((label, tuple(requirements)))
+
+attr_matchers = {
+    attr: attr_matcher(patterns) for attr, patterns in _attr_patterns.items()
+}
+
+#: Matches package files, capturing the package name
+package_path_regex = re.compile(r"var/spack/repos/builtin/packages/([^/]+)/package.py$")
+
+
 async def add_labels(event, gh):
     """
     Add labels to a pull request
@@ -143,43 +211,42 @@ async def add_labels(event, gh):
 
     # Iterate over modified files and create a list of labels
     # https://developer.github.com/v3/pulls/#list-pull-requests-files
-    labels = set()
-    async for file in gh.getiter(pull_request["url"] + "/files"):
+    found = set()
+    for file in await helpers.list_pr_files(gh, pull_request):
         filename = file["filename"]
-        status = file["status"]
-        logger.info(f"Filename: {filename}")
-        logger.info(f"Status: {status}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Filename: %s, status: %s", filename, file["status"])
 
         # Add our own "package" attribute to the file, if it's a package
-        match = re.match(
-            r"var/spack/repos/builtin/packages/([^/]+)/package.py$", filename
-        )
+        match = package_path_regex.match(filename)
         file["package"] = match.group(1) if match else ""
 
-        # If the file's attributes match any patterns in label_patterns, add
-        # the corresponding labels.
-        for label, pattern_dict in label_patterns.items():
-            attr_matches = []
-            # Pattern matches for for each attribute are or'd together
-            for attr, patterns in pattern_dict.items():
-                # 'patch' is an example of an attribute that is not required to
-                # appear in response when listing pull request files.  See here:
-                #
-                #    https://docs.github.com/en/rest/pulls/pulls#list-pull-requests-files
-                #
-                # If we don't get some attribute in the response, no labels that
-                # depend on finding a match in that attribute should be added.
-                attr_matches.append(
-                    any(p.search(file[attr]) for p in patterns)
-                    if attr in file
-                    else False
-                )
-            # If all attributes have at least one pattern match, we add the label
-            if all(attr_matches):
-                labels.add(label)
+        #
+        # 'patch' is an example of an attribute that is not required to
+        # appear in response when listing pull request files.  See here:
+        #
+        #    https://docs.github.com/en/rest/pulls/pulls#list-pull-requests-files
+        #
+        # If we don't get some attribute in the response, no labels that
+        # depend on finding a match in that attribute should be added.
+        matches = {
+            attr: set(match(file[attr]))
+            for attr, match in attr_matchers.items()
+            if file.get(attr) is not None
+        }
+
+        # Pattern matches for each attribute are or'd together, and all
+        # attributes must match for the label to be added.
+        for label, requirements in label_requirements:
+            if label not in found and all(
+                attr in matches and not indices.isdisjoint(matches[attr])
+                for attr, indices in requirements
+            ):
+                found.add(label)
 
+    labels = [label for label, _ in label_requirements if label in found]
     logger.info(f"Adding the following labels: {labels}")
 
     # https://developer.github.com/v3/issues/labels/#add-labels-to-an-issue
     if labels:
-        await gh.post(pull_request["issue_url"] + "/labels", data=list(labels))
+        await gh.post(pull_request["issue_url"] + "/labels", data=labels)
@@ -3,6 +3,10 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import uuid
+
+from rq import Queue
+
 import spackbot.helpers as helpers
 from spackbot.helpers import (
     pr_expected_base,
@@ -12,8 +16,7 @@ from spackbot.helpers import (
 )
 from spackbot.workers import (
     copy_pr_mirror,
-    prune_mirror_duplicates,
-    update_mirror_index,
+    prune_and_reindex_mirror,
     delete_pr_mirror,
     get_queue,
     TASK_QUEUE_LONG,
@@ -43,13 +46,18 @@ async def close_pr_mirror(event, gh):
 
     # Get task queue info
     ltask_q = get_queue(TASK_QUEUE_LONG)
-    copy_job = None
+    copy_job_id = None
     job_metadata = {
         "type": None,
         "pr_number": pr_number,
         "pr_branch": pr_branch,
     }
 
+    # Jobs are prepared here and then enqueued together, in one round trip
+    # to redis. Dependencies refer to jobs by id, so pick the id of the copy
+    # job up front.
+    jobs = []
+
     if is_merged and base_branch == pr_expected_base:
         logger.info(
             f"PR {pr_number}/{pr_branch} merged to develop, graduating binaries"
@@ -57,52 +65,45 @@ async def close_pr_mirror(event, gh):
 
         # Copy all of the stack binaries from the PR to the shared PR
         # mirror.
-        job_metadata.update({"type": "copy"})
-        copy_job = ltask_q.enqueue(
-            copy_pr_mirror,
-            pr_mirror_url,
-            shared_pr_mirror_url,
-            meta=job_metadata,
-            job_timeout=WORKER_JOB_TIMEOUT,
+        copy_job_id = str(uuid.uuid4())
+        jobs.append(
+            Queue.prepare_data(
+                copy_pr_mirror,
+                args=(pr_mirror_url, shared_pr_mirror_url),
+                meta={**job_metadata, "type": "copy"},
+                timeout=WORKER_JOB_TIMEOUT,
+                job_id=copy_job_id,
+            )
         )
-        logger.info(f"Copy job queued: {copy_job.id}")
 
         # Prune duplicates that have been published after copy
-        # since copy may have introduced duplicates for some reason
-        job_metadata.update({"type": "prune"})
+        # since copy may have introduced duplicates for some reason,
+        # then reindex the stack mirrors. Both steps share one job so
+        # spack is only cloned once.
         shared_stack_pr_mirror_url = f"{shared_pr_mirror_url}/{{stack}}"
         publish_stack_mirror_url = (
             f"{publish_mirror_base_url}/{{stack}}/{pr_expected_base}"
         )
-        prune_job = ltask_q.enqueue(
-            prune_mirror_duplicates,
-            shared_stack_pr_mirror_url,
-            publish_stack_mirror_url,
-            job_timeout=WORKER_JOB_TIMEOUT,
-            depends_on=copy_job,
-            meta=job_metadata,
+        jobs.append(
+            Queue.prepare_data(
+                prune_and_reindex_mirror,
+                args=(shared_stack_pr_mirror_url, publish_stack_mirror_url),
+                timeout=WORKER_JOB_TIMEOUT,
+                depends_on=copy_job_id,
+                meta={**job_metadata, "type": "prune-reindex"},
+            )
         )
-        logger.info(f"Pruning job queued: {prune_job.id}")
-
-        # Queue a reindex for the stack mirror to attempt to run after
-        # prune.
-        job_metadata.update({"type": "reindex"})
-        update_job = ltask_q.enqueue(
-            update_mirror_index,
-            shared_stack_pr_mirror_url,
-            job_timeout=WORKER_JOB_TIMEOUT,
-            depends_on=prune_job,
-            meta=job_metadata,
-        )
-        logger.info(f"Reindex job queued: {update_job.id}")
 
     # Delete the mirror
-    job_metadata.update({"type": "delete"})
-    del_job = ltask_q.enqueue(
-        delete_pr_mirror,
-        pr_mirror_url,
-        meta=job_metadata,
-        job_timeout=WORKER_JOB_TIMEOUT,
-        depends_on=copy_job,
+    jobs.append(
+        Queue.prepare_data(
+            delete_pr_mirror,
+            args=(pr_mirror_url,),
+            meta={**job_metadata, "type": "delete"},
+            timeout=WORKER_JOB_TIMEOUT,
+            depends_on=copy_job_id,
+        )
     )
-    logger.info(f"Delete job queued: {del_job.id}")
+
+    for job in ltask_q.enqueue_many(jobs):
+        logger.info(f"{job.meta['type'].capitalize()} job queued: {job.id}")
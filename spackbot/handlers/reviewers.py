@@ -3,49 +3,321 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
-import os
+import asyncio
 import re
+import time
 
-import sh
-from sh.contrib import git
+import aiohttp
 import spackbot.helpers as helpers
 import spackbot.comments as comments
 from gidgethub import BadRequest
 
+try:
+    # google-re2 matches in linear time, which matters for the untrusted patch
+    # text we scan here
+    import re2 as linear_re
+except ImportError:
+    linear_re = re
+
 logger = helpers.get_logger(__name__)
 
+#: Matches ``maintainers = [...]`` lists and ``maintainers(...)`` directives.
+#: Each form only ends at its own closing bracket, so there is a single way to
+#: match and nothing to backtrack over.
+maintainers_regex = linear_re.compile(r"maintainers(?:\([^)]*\)|\s*=\s*\[[^\]]*\])")
+
+#: Matches quoted strings (i.e. GitHub handles) in a maintainers list
+quoted_regex = linear_re.compile("['\"][^'\"]*['\"]")
+
+#: Matches imports from builtin packages or build systems, capturing the kind
+#: of module (empty for relative imports between build systems), the module
+#: and the names imported
+import_regex = re.compile(
+    r"^from\s+(spack\.pkg\.builtin|spack\.build_systems|)\.(\w+)\s+import\s+"
+    r"(\([^)]*\)|.*)",
+    re.M,
+)
+
+#: Matches a name in an import, capturing the name and what it's imported as
+imported_name_regex = re.compile(r"(\w+)(?:\s+as\s+(\w+))?")
+
+#: Matches base classes given by module, like ``spack.pkg.builtin.mpich.Mpich``
+dotted_class_regex = re.compile(
+    r"(?:spack\.pkg\.)?(builtin|spack\.build_systems)\.(\w+)\.(\w+)$"
+)
+
+#: Matches the start of a top-level class
+class_regex = re.compile(r"^class\s", re.M)
+
+#: Matches Python comments
+comment_regex = re.compile(r"#.*")
+
+#: The module package files import build systems and mixins from
+spack_package_path = "lib/spack/spack/package.py"
+
+#: Replaces special characters in issue titles with spaces
+title_special_chars_table = str.maketrans(dict.fromkeys("!#%^*(){}:_&$+@/[]", " "))
+
+#: How long maintainers looked up on spack develop are reused, in seconds
+develop_maintainers_ttl = 10 * 60
+
+#: Don't ask maintainers for review if more packages than this are modified
+max_review_packages = 100
+
+#: Maps package names to ``(expiry time, maintainers)`` from spack develop
+_develop_maintainers = {}
+
+#: How many files to download from develop at once
+develop_fetch_jobs = 16
+
+#: Give up on downloading a file from develop after this long
+develop_fetch_timeout = aiohttp.ClientTimeout(total=30)
+
+#: How many GitHub API requests to have in flight at once when checking or
+#: inviting maintainers. GitHub's secondary rate limits discourage more.
+github_request_jobs = 5
+
+
+def maintainers_in(code):
+    """
+    Return the set of GitHub handles in maintainers lists in some package code.
+    """
+    # Look for quoted handles within each list in place, without copying it out
+    handles = set()
+    for array in maintainers_regex.finditer(code):
+        handles.update(
+            m.strip("'\"") for m in quoted_regex.findall(code, *array.span())
+        )
+    return handles
+
+
+def package_path(package):
+    """Return the path of a builtin package's package.py in spack."""
+    return f"var/spack/repos/builtin/packages/{package}/package.py"
+
+
+def package_class(package):
+    """Return the name of a package's class, as spack derives it."""
+    name = "".join(part.capitalize() for part in re.split(r"[-_]", package))
+    return f"_{name}" if name[:1].isdigit() else name
+
+
+def module_path(kind, module):
+    """
+    Return the path in spack of a module in ``spack.pkg.builtin`` (a package)
+    or ``spack.build_systems``.
+    """
+    if kind.endswith("builtin"):
+        # Package names starting with a digit get a prefix as modules
+        if re.match(r"num\d", module):
+            module = module[3:]
+        return package_path(module.replace("_", "-"))
+    return f"lib/spack/spack/build_systems/{module}.py"
+
+
+def imported_classes(code):
+    """
+    Return a dict mapping names imported from packages or build systems in some
+    code to the ``(path, class)`` they come from.
+    """
+    classes = {}
+    for kind, module, names in import_regex.findall(code):
+        path = module_path(kind, module)
+        for name, alias in imported_name_regex.findall(comment_regex.sub("", names)):
+            classes[alias or name] = (path, name)
+    return classes
+
+
+def class_maintainers_and_bases(code, cls, exported):
+    """
+    Return the maintainers of top-level class ``cls`` in some code, and the
+    ``(path, class)`` of each of its base classes that is a package or a build
+    system. ``exported`` maps the names ``spack.package`` exports to theirs.
+
+    If there is no such class, return all the maintainers in the code.
+    """
+    match = re.search(rf"^class\s+{re.escape(cls)}\b\s*(?:\(([^)]*)\))?", code, re.M)
+    if not match:
+        return maintainers_in(code), ()
+
+    end = class_regex.search(code, match.end())
+    body = code[match.end() : end.start() if end else len(code)]
+
+    imported = imported_classes(code)
+    bases = []
+    for base in comment_regex.sub("", match.group(1) or "").split(","):
+        base = base.strip()
+        dotted = dotted_class_regex.match(base)
+        if dotted:
+            bases.append((module_path(*dotted.group(1, 2)), dotted.group(3)))
+            continue
+        if base in imported or base in exported:
+            bases.append(imported.get(base) or exported[base])
+
+    return maintainers_in(body), tuple(bases)
+
+
+async def fetch_develop_file(session, path, semaphore):
+    """
+    Return the text of a file on spack develop, an empty string if there is no
+    such file, or None if it couldn't be downloaded.
+    """
+    url = f"{helpers.spack_develop_raw_url}/{path}"
+    async with semaphore:
+        try:
+            async with session.get(url, timeout=develop_fetch_timeout) as response:
+                if response.status == 200:
+                    return await response.text()
+                if response.status == 404:
+                    return ""
+                logger.warning(f"Couldn't download {url}: HTTP {response.status}")
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Couldn't download {url}: {e!r}")
+    return None
+
+
+async def get_develop_maintainers(packages, session=None):
+    """
+    Return a dict mapping each package to a tuple of its maintainers on spack
+    develop. Lookups from the last ``develop_maintainers_ttl`` seconds are
+    reused, so we only download package files we haven't seen recently.
+
+    Like ``spack maintainers``, this includes maintainers inherited from the
+    package's base classes: build systems, mixins like ``CudaPackage``, and
+    other packages.
+
+    Uses ``session`` if given, otherwise creates a new session for the
+    downloads.
+    """
+    now = time.monotonic()
+    result = {}
+    missing = []
+    for package in packages:
+        cached = _develop_maintainers.get(package)
+        if cached and cached[0] > now:
+            result[package] = cached[1]
+        else:
+            missing.append(package)
+
+    if not missing:
+        return result
+
+    if not session:
+        async with aiohttp.ClientSession() as session:
+            return await get_develop_maintainers(packages, session)
+
+    # Download just the files we need rather than cloning spack. We only read
+    # them; we never run spack, from develop or from the PR. Each file is only
+    # downloaded once, however many of the packages use it.
+    # Don't provide endpoint with credentials!
+    semaphore = asyncio.Semaphore(develop_fetch_jobs)
+    downloads = {}
+
+    def download(path):
+        if path not in downloads:
+            downloads[path] = asyncio.ensure_future(
+                fetch_develop_file(session, path, semaphore)
+            )
+        return downloads[path]
+
+    async def class_maintainers(path, cls, seen):
+        """
+        Return the maintainers of a class, including those of its base classes,
+        or None if a file couldn't be downloaded.
+        """
+        if (path, cls) in seen:
+            return set()
+        seen.add((path, cls))
+
+        # Build systems and mixins are usually imported from spack.package
+        code, spack_package = await asyncio.gather(
+            download(path), download(spack_package_path)
+        )
+        if code is None or spack_package is None:
+            return None
+
+        exported = imported_classes(spack_package)
+        maintainers, bases = class_maintainers_and_bases(code, cls, exported)
+        inherited = await asyncio.gather(
+            *(class_maintainers(base_path, base, seen) for base_path, base in bases)
+        )
+        if None in inherited:
+            return None
+        return maintainers.union(*inherited)
+
+    found = await asyncio.gather(
+        *(
+            class_maintainers(package_path(package), package_class(package), set())
+            for package in missing
+        )
+    )
+
+    for package, maintainers in zip(missing, found):
+        # Don't remember failed downloads; try again next time
+        if maintainers is None:
+            result[package] = ()
+            continue
+        maintainers = tuple(sorted(maintainers))
+        _develop_maintainers[package] = (now + develop_maintainers_ttl, maintainers)
+        result[package] = maintainers
+
+    return result
+
 
-async def parse_maintainers_from_patch(gh, pull_request):
+async def changed_packages_and_maintainers(gh, pull_request, limit=None):
     """
-    Get any new or removed maintainers from the patch data in the PR.
+    Return the packages modified by a PR, and any new or removed maintainers
+    of those packages from the patch data in the PR, from a single pass over
+    the PR's files.
 
-    We parse this from the patch because running the spack from the PR as this
-    bot is unsafe; the bot is privileged and we do not trust code from PRs.
+    If more than ``limit`` packages are modified, stop listing files as soon
+    as that's clear; the caller only needs to know that there are too many.
 
+    Ignore deleted packages, since we can no longer query them for
+    maintainers.
+
+    We parse maintainers from the patch because running the spack from the PR
+    as this bot is unsafe; the bot is privileged and we do not trust code from
+    PRs.
     """
+    packages = []
     maintainers = {}
-    async for file in gh.getiter(pull_request["url"] + "/files"):
+    files_url = f"{pull_request['url']}/files?per_page={helpers.pr_files_per_page}"
+    async for file in gh.getiter(files_url):
+        # Most files in big PRs aren't packages; don't run the regex on those
         filename = file["filename"]
-        if not filename.endswith("package.py"):
+        if file["status"] == "removed" or not filename.endswith("/package.py"):
             continue
 
-        pkg = re.search(r"/([^/]+)/package.py", filename).group(1)
+        match = helpers.package_path_regex.match(filename)
+        if not match:
+            continue
+        pkg = match.group(1)
+        packages.append(pkg)
+        if limit is not None and len(packages) > limit:
+            break
+
+        # Most patches don't touch maintainers; skip the regex scan for those.
+        # Very large diffs have no patch at all.
+        code = file.get("patch", "")
+        if "maintainers" not in code:
+            continue
 
-        code = file["patch"]
-        arrays = re.findall(r"maintainers(?:\(|\s*=\s*\[)[^\]\)]*(?:\)|\])", code)
-        for array in arrays:
-            file_maintainers = re.findall("['\"][^'\"]*['\"]", array)
-            for m in file_maintainers:
-                maintainers.setdefault(pkg, set()).add(m.strip("'\""))
+        file_maintainers = maintainers_in(code)
+        if file_maintainers:
+            maintainers.setdefault(pkg, set()).update(file_maintainers)
 
-    return maintainers
+    return packages, maintainers
 
 
-async def find_maintainers(gh, packages, repository, pull_request, number):
+async def find_maintainers(packages, patch_maintainers, pull_request, session=None):
     """
     Return an array of packages with maintainers, an array of packages
     without maintainers, and a set of maintainers.
 
+    ``patch_maintainers`` has any maintainers added or removed in the PR, by
+    package. Do NOT run spack from the PR to find these.
+
     Ignore the author of the PR, as they don't need to review their own PR.
     """
     author = pull_request["user"]["login"]
@@ -54,48 +326,34 @@ async def find_maintainers(gh, packages, repository, pull_request, number):
     with_maintainers = []
     without_maintainers = []
 
-    # parse any added/removed maintainers from the PR. Do NOT run spack from the PR
-    patch_maintainers = await parse_maintainers_from_patch(gh, pull_request)
     logger.info(f"Maintainers from patch: {patch_maintainers}")
 
     all_maintainers = set()
-    with helpers.temp_dir() as cwd:
-        # Clone spack develop (shallow clone for speed)
-        # WARNING: We CANNOT run spack from the PR, as it is untrusted code.
-        # WARNING: If we run that, an attacker could run anything as this bot.
-        git("clone", "--depth", "1", helpers.spack_develop_url)
-
-        # Get spack executable
-        spack = sh.Command(f"{cwd}/spack/bin/spack")
-
-        for package in packages:
-            logger.info(f"Package: {package}")
-
-            # Query maintainers from develop
-            maintainers = spack("maintainers", package, _ok_code=(0, 1)).split()
-            maintainers = set(maintainers)
+    develop_maintainers = await get_develop_maintainers(packages, session)
+    for package in packages:
+        logger.info(f"Package: {package}")
 
-            # add in maintainers from the PR patch
-            maintainers |= patch_maintainers.get(package, set())
+        # Maintainers from develop, plus those from the PR patch
+        maintainers = set(develop_maintainers[package])
+        maintainers.update(patch_maintainers.get(package, ()))
 
-            logger.info("Maintainers: %s" % ", ".join(sorted(maintainers)))
+        logger.info("Maintainers: %s" % ", ".join(sorted(maintainers)))
 
-            if not maintainers:
-                without_maintainers.append(package)
-                continue
+        if not maintainers:
+            without_maintainers.append(package)
+            continue
 
-            # No need to ask the author to review their own PR
-            if author in maintainers:
-                maintainers.remove(author)
+        # No need to ask the author to review their own PR
+        maintainers.discard(author)
 
-            if maintainers:
-                with_maintainers.append(package)
-                all_maintainers |= maintainers
+        if maintainers:
+            with_maintainers.append(package)
+            all_maintainers |= maintainers
 
     return with_maintainers, without_maintainers, all_maintainers
 
 
-async def add_issue_maintainers(event, gh, package_list):
+async def add_issue_maintainers(event, gh, package_list=None, session=None):
     """
     Assign maintainers of packages based on issue title.
 
@@ -104,43 +362,33 @@ async def add_issue_maintainers(event, gh, package_list):
     to explicitly name a list of one or more packages, and then use that
     instead of parsing the title, as we do here.
     """
-    # Add extra space to start and end of title so we catch matches at ends
-    title = " " + event.data["issue"]["title"].lower() + " "
-
     # Replace special characters with spaces
-    title = re.sub(r"[!#%^*(){}:_&$+@\/\[\]]+", " ", title)
-
-    # Does the title have a known package (must have space before and after)
-    package_regex = "( %s )" % " | ".join(package_list)
-    packages = re.findall(package_regex, title)
+    title = event.data["issue"]["title"].lower().translate(title_special_chars_table)
+
+    # Does the title have a known package (as a whole, space-separated word).
+    # Look words up in a set rather than building a regex of every package;
+    # list_packages already returns one.
+    if package_list is None:
+        package_list = await helpers.list_packages(session)
+    if isinstance(package_list, (set, frozenset)):
+        package_set = package_list
+    else:
+        package_set = set(package_list)
+    packages = [word for word in dict.fromkeys(title.split()) if word in package_set]
 
     # If we match a package in the title, look for maintainers to ping
     if packages:
-        # Remove extra spacing that helped search
-        packages = [x.strip() for x in packages]
-
         # Look for maintainers of the package
         messages = []
-        with helpers.temp_dir() as cwd:
-            git("clone", "--depth", "1", helpers.spack_develop_url)
-
-            # Add `spack` to PATH
-            os.environ["PATH"] = f"{cwd}/spack/bin:" + os.environ["PATH"]
-            from sh import spack
-
-            for package in packages:
-                # Query maintainers from develop
-                found_maintainers = spack(
-                    "maintainers", package, _ok_code=(0, 1)
-                ).split()
-                if found_maintainers:
-                    found_maintainers = " ".join(
-                        ["@%s," % m for m in found_maintainers]
-                    )
-                    messages.append(
-                        "- Hey %s, it looks like you might know about the %s package. Can you help with this issue?"
-                        % (found_maintainers, package)
-                    )
+        develop_maintainers = await get_develop_maintainers(packages, session)
+        for package in packages:
+            found_maintainers = develop_maintainers[package]
+            if found_maintainers:
+                found_maintainers = " ".join(["@%s," % m for m in found_maintainers])
+                messages.append(
+                    "- Hey %s, it looks like you might know about the %s package. Can you help with this issue?"
+                    % (found_maintainers, package)
+                )
 
         # If we have maintainers, ping them for help in the issue
         if messages:
@@ -152,7 +400,52 @@ async def add_issue_maintainers(event, gh, package_list):
             )
 
 
-async def add_reviewers(event, gh):
+async def check_collaborator(gh, collaborators_url, user, semaphore):
+    """
+    Return whether a user is a collaborator on the repository, and so can be
+    requested for review.
+    """
+    async with semaphore:
+        logger.info(f"User: {user}")
+
+        # https://api.github.com/repos/spack/spack/collaborators/{user}
+        # will return 404 if the user is not a collaborator, BUT
+        # https://api.github.com/repos/spack/spack/collaborators/{user}/permission
+        # will show read for pretty much anyone for public repos. So we have to
+        # check the first URL first.
+        if not await helpers.found(
+            gh.getitem(collaborators_url, {"collaborator": user})
+        ):
+            logger.info(f"Not found: {user}")
+            return False
+
+        # only check permission once we know they're a collaborator
+        result = await gh.getitem(
+            collaborators_url + "/permission",
+            {"collaborator": user},
+        )
+        level = result["permission"]
+        logger.info(f"Permission level of {user}: {level}")
+        return True
+
+
+async def add_team_member(gh, members_url, user, semaphore):
+    """
+    Invite a user to a team, given the team's memberships URL.
+    """
+    async with semaphore:
+        try:
+            await gh.put(members_url, {"member": user}, data={"role": "member"})
+        except BadRequest as e:
+            if e.status_code == 404:
+                logger.warning(
+                    f"Skipping adding member {user}, likely already added: {e}"
+                )
+            else:
+                raise e
+
+
+async def add_reviewers(event, gh, session=None):
     """
     Add a comment on a PR to ping maintainers to review the PR.
 
@@ -171,15 +464,17 @@ async def add_reviewers(event, gh):
 
     logger.info(f"Looking for reviewers for PR #{number}...")
 
-    packages = await helpers.changed_packages(gh, pull_request)
+    packages, patch_maintainers = await changed_packages_and_maintainers(
+        gh, pull_request, limit=max_review_packages
+    )
 
     # Don't ask maintainers for review if hundreds of packages are modified,
     # it's probably just a license or Spack API change, not a package change.
-    if len(packages) > 100:
+    if len(packages) > max_review_packages:
         return
 
     maintained_pkgs, unmaintained_pkgs, maintainers = await find_maintainers(
-        gh, packages, repository, pull_request, number
+        packages, patch_maintainers, pull_request, session
     )
 
     # Ask people to maintain packages that don't have maintainers.
@@ -198,32 +493,17 @@ async def add_reviewers(event, gh):
     if maintainers:
         # See which maintainers have permission to be requested for review
         # Requires at least "read" permission.
-        reviewers = []
-        non_reviewers = []
-        for user in maintainers:
-            logger.info(f"User: {user}")
-
-            # https://api.github.com/repos/spack/spack/collaborators/{user}
-            # will return 404 if the user is not a collaborator, BUT
-            # https://api.github.com/repos/spack/spack/collaborators/{user}/permission
-            # will show read for pretty much anyone for public repos. So we have to
-            # check the first URL first.
-            collaborators_url = repository["collaborators_url"]
-            if not await helpers.found(
-                gh.getitem(collaborators_url, {"collaborator": user})
-            ):
-                logger.info(f"Not found: {user}")
-                non_reviewers.append(user)
-                continue
-
-            # only check permission once we know they're a collaborator
-            result = await gh.getitem(
-                collaborators_url + "/permission",
-                {"collaborator": user},
+        collaborators_url = repository["collaborators_url"]
+        semaphore = asyncio.Semaphore(github_request_jobs)
+        users = sorted(maintainers)
+        is_collaborator = await asyncio.gather(
+            *(
+                check_collaborator(gh, collaborators_url, user, semaphore)
+                for user in users
             )
-            level = result["permission"]
-            logger.info(f"Permission level: {level}")
-            reviewers.append(user)
+        )
+        reviewers = [user for user, ok in zip(users, is_collaborator) if ok]
+        non_reviewers = [user for user, ok in zip(users, is_collaborator) if not ok]
 
         # If they have permission, add them
         # https://docs.github.com/en/rest/reference/pulls#request-reviewers-for-a-pull-request
@@ -260,18 +540,12 @@ async def add_reviewers(event, gh):
                 logger.info("No 'maintainers' team; not adding collaborators")
             else:
                 logger.info(f"Adding collaborators: {non_reviewers}")
-                for user in non_reviewers:
-                    try:
-                        await gh.put(
-                            members_url, {"member": user}, data={"role": "member"}
-                        )
-                    except BadRequest as e:
-                        if e.status_code == 404:
-                            logger.warning(
-                                f"Skipping adding member {user}, likely already added: {e}"
-                            )
-                        else:
-                            raise e
+                await asyncio.gather(
+                    *(
+                        add_team_member(gh, members_url, user, semaphore)
+                        for user in non_reviewers
+                    )
+                )
 
             # https://docs.github.com/en/rest/reference/issues#create-an-issue-comment
             comment_body = comments.non_reviewers_comment.format(
@@ -26,9 +26,10 @@ async def style_comment(event, gh):
     # Find the pull request that is matched to the repository. It looks like
     # checks are shared across different repos (e.g., a fork and upstream)
     repository = event.data["repository"]["full_name"]  # "spack-test/spack"
+    repository_id = event.data["repository"]["id"]
     for pr in event.data["check_run"]["pull_requests"]:  # []
-        if repository in pr["url"]:
-            number = pr["url"].split("/")[-1]
+        if pr["base"]["repo"]["id"] == repository_id:
+            number = pr["number"]
             comments_url = (
                 f"https://api.github.com/repos/{repository}/issues/{number}/comments"
             )
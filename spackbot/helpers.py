@@ -5,25 +5,40 @@
 
 
 import aiohttp
+import asyncio
 import contextlib
 import gidgethub
 import json
 import logging
 import os
+import random
 import re
+import socket
 import tempfile
+import time
 
-from datetime import datetime
 from io import StringIO
 from sh import ErrorReturnCode
+from urllib.error import HTTPError, URLError
 from urllib.request import HTTPHandler, Request, build_opener
 from urllib.parse import urlparse
 
+try:
+    # orjson decodes large JSON responses several times faster
+    from orjson import dumps as json_dumps_bytes
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+    def json_dumps_bytes(obj):
+        return json.dumps(obj).encode("utf-8")
+
 
 """Shared function helpers that can be used across routes"
 """
 
 spack_develop_url = "https://github.com/spack/spack"
+spack_develop_raw_url = "https://raw.githubusercontent.com/spack/spack/develop"
 spack_gitlab_url = "https://gitlab.spack.io"
 spack_upstream = "git@github.com:spack/spack"
 
@@ -32,7 +47,20 @@ gitlab_spack_project_url = os.environ.get(
     "GITLAB_SPACK_PROJECT_URL", "https://gitlab.spack.io/api/v4/projects/2"
 )
 
+# Accounts created after this date have their id in their noreply email
+noreply_id_email_since = "2017-07-18"
+
+# list_packages reuses the package list for this long, in seconds, then only
+# downloads it again if it changed.
+packages_ttl = 60 * 60
+_packages = {"etag": None, "expires": 0, "names": frozenset(), "lock": None}
+
+# GitHub lists at most 100 files per page, and at most 3000 files in total
+pr_files_per_page = 100
+pr_files_max_pages = 30
+
 package_path = r"^var/spack/repos/builtin/packages/(\w[\w-]*)/package.py$"
+package_path_regex = re.compile(package_path)
 
 # Bot name can be modified in the environment
 botname = os.environ.get("SPACKBOT_NAME", "@spackbot")
@@ -51,7 +79,7 @@ publish_mirror_base_url = "s3://spack-binaries"
 
 # Aliases for spackbot so spackbot doesn't respond to himself
 aliases = ["spack-bot", "spackbot", "spack-bot-develop", botname]
-alias_regex = "(%s)" % "|".join(aliases)
+alias_regex = re.compile("(%s)" % "|".join(map(re.escape, aliases)))
 
 __spackbot_log_level = None
 __supported_log_levels = ("DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL")
@@ -79,56 +107,91 @@ logger = get_logger(__name__)
 logger.info(f"bot name is {botname}")
 
 
-async def list_packages():
+async def list_packages(session=None):
     """
-    Get a list of package names
+    Get a set of package names. Uses ``session`` if given, otherwise creates
+    a new session for a one-off request. If the request fails, returns the
+    last list we got (empty if there is none).
     """
-    # Don't provide endpoint with credentials!
-    async with aiohttp.ClientSession() as session:
-        async with session.get(
-            "https://packages.spack.io/data/packages.json"
-        ) as response:
-            response = await response.json()
+    if _packages["expires"] > time.monotonic():
+        return _packages["names"]
 
-    return [x["name"].lower() for x in response]
+    if not session:
+        async with aiohttp.ClientSession() as session:
+            return await list_packages(session)
 
+    # Only one caller at a time downloads the list; any others that find it
+    # expired wait, then use what it got. The lock is made here rather than at
+    # import, so it belongs to the running event loop.
+    if _packages["lock"] is None:
+        _packages["lock"] = asyncio.Lock()
 
-async def changed_packages(gh, pull_request):
-    """Return an array of packages that were modified by a PR.
+    async with _packages["lock"]:
+        if _packages["expires"] > time.monotonic():
+            return _packages["names"]
 
-    Ignore deleted packages, since we can no longer query them for
-    maintainers.
+        headers = {}
+        if _packages["etag"]:
+            headers["If-None-Match"] = _packages["etag"]
 
-    """
-    # see which files were modified
-    packages = []
-    async for f in gh.getiter(pull_request["url"] + "/files"):
-        filename = f["filename"]
-        status = f["status"]
+        # Don't provide endpoint with credentials!
+        try:
+            async with session.get(
+                "https://packages.spack.io/data/packages.json", headers=headers
+            ) as response:
+                if response.status == 200:
+                    packages = await response.json(loads=json_loads)
+                    _packages["names"] = frozenset(x["name"].lower() for x in packages)
+                    _packages["etag"] = response.headers.get("ETag")
+                elif response.status != 304:
+                    logger.warning(
+                        f"Package list request returned {response.status}, "
+                        "keeping the previous list"
+                    )
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logger.warning(
+                f"Couldn't get the package list ({e}), keeping the previous one"
+            )
 
-        if status == "removed":
-            continue
+        # Don't retry a failed request on every call either; try again after the TTL
+        _packages["expires"] = time.monotonic() + packages_ttl
+    return _packages["names"]
 
-        match = re.match(package_path, filename)
-        if not match:
-            continue
-        packages.append(match.group(1))
 
-    return packages
+async def list_pr_files(gh, pull_request):
+    """
+    Return the files modified by a PR, as listed by the GitHub API.
+
+    The number of changed files is part of the pull request, so all pages
+    are requested at once rather than one after another.
+    """
+    url = pull_request["url"] + "/files"
+
+    if "changed_files" not in pull_request:
+        url = f"{url}?per_page={pr_files_per_page}"
+        return [f async for f in gh.getiter(url)]
+
+    pages = -(-pull_request["changed_files"] // pr_files_per_page)
+    pages = min(max(pages, 1), pr_files_max_pages)
+    results = await asyncio.gather(
+        *(
+            gh.getitem(f"{url}?per_page={pr_files_per_page}&page={page}")
+            for page in range(1, pages + 1)
+        )
+    )
+    return [f for result in results for f in result]
 
 
 @contextlib.contextmanager
 def temp_dir():
     """
-    Create a temporary directory, cd into it, destroy it and cd back when done.
+    Create a temporary directory and destroy it when done.
+
+    This doesn't cd into the directory, since the working directory is shared
+    by everything running in the process; use paths inside it instead.
     """
-    pwd = os.getcwd()
     with tempfile.TemporaryDirectory() as temp_dir:
-        try:
-            os.chdir(temp_dir)
-            yield temp_dir
-        finally:
-            os.chdir(pwd)
+        yield temp_dir
 
 
 async def get_user_email(gh, user):
@@ -136,32 +199,57 @@ async def get_user_email(gh, user):
     Given a username, get the correct email based on creation date
     """
     response = await gh.getitem(f"https://api.github.com/users/{user}")
-    created_at = datetime.strptime(response["created_at"].split("T", 1)[0], "%Y-%m-%d")
-    split = datetime.strptime("2017-07-18", "%Y-%m-%d")
-    if created_at > split:
+
+    # ISO 8601 dates compare correctly as strings
+    if response["created_at"][:10] > noreply_id_email_since:
         email = f"{response['id']}+{user}@users.noreply.github.com"
     else:
         email = f"{user}@users.noreply.github.com"
     return email
 
 
-def run_command(control, cmd, ok_codes=None):
+class CappedStringIO(StringIO):
+    """
+    A StringIO that keeps only the first limit characters written to it
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.remaining = limit
+
+    def write(self, s):
+        if self.remaining > 0:
+            self.remaining -= super().write(s[: self.remaining])
+        return len(s)
+
+
+def run_command(control, cmd, ok_codes=None, limit=None):
     """
     Run a spack or git command and get output and error
+
+    If limit is given, only keep that many characters of each.
     """
     ok_codes = ok_codes or [0, 1]
-    res = StringIO()
-    err = StringIO()
+    if limit is None:
+        res = StringIO()
+        err = StringIO()
+    else:
+        res = CappedStringIO(limit)
+        err = CappedStringIO(limit)
 
     try:
         control(*cmd, _out=res, _err=err, _ok_code=ok_codes)
-    except ErrorReturnCode as inst:
-        logger.error(f"cmd {cmd} exited non-zero")
-        logger.error(f"stdout from {cmd}:")
-        logger.error(res.getvalue())
-        logger.error(f"stderr from {cmd}:")
-        logger.error(err.getvalue())
-        raise inst
+    except ErrorReturnCode:
+        # One record, so the output isn't interleaved with other log lines
+        logger.error(
+            "cmd %s exited non-zero\nstdout from %s:\n%s\nstderr from %s:\n%s",
+            cmd,
+            cmd,
+            res.getvalue(),
+            cmd,
+            err.getvalue(),
+        )
+        raise
 
     return res.getvalue(), err.getvalue()
 
@@ -182,34 +270,61 @@ async def found(coroutine):
         raise
 
 
-async def post(url, headers):
+async def post(url, headers, session=None):
     """
-    Convenience method to create a new session and make a one-off
-    post request, given a url and headers to include in the request.
+    Convenience method to make a post request, given a url and headers to
+    include in the request. Uses ``session`` if given, otherwise creates a
+    new session for a one-off request.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, headers=headers) as response:
-            return await response.json()
+    if not session:
+        async with aiohttp.ClientSession() as session:
+            return await post(url, headers, session)
+
+    async with session.post(url, headers=headers) as response:
+        return await response.json(loads=json_loads)
 
 
-async def get(url, headers):
+async def get(url, headers, session=None):
     """
-    Convenience method to create a new session and make a one-off
-    get request, given a url and headers to include in the request.
+    Convenience method to make a get request, given a url and headers to
+    include in the request. Uses ``session`` if given, otherwise creates a
+    new session for a one-off request.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers) as response:
-            return await response.json()
+    if not session:
+        async with aiohttp.ClientSession() as session:
+            return await get(url, headers, session)
 
+    async with session.get(url, headers=headers) as response:
+        return await response.json(loads=json_loads)
 
-async def delete(url, headers):
+
+async def delete(url, headers, session=None):
     """
-    Convenience method to create a new session and make a one-off
-    delete request, given a url and headers to include in the request.
+    Convenience method to make a delete request, given a url and headers to
+    include in the request. Uses ``session`` if given, otherwise creates a
+    new session for a one-off request.
     """
-    async with aiohttp.ClientSession() as session:
-        async with session.delete(url, headers=headers) as response:
-            return await response.json()
+    if not session:
+        async with aiohttp.ClientSession() as session:
+            return await delete(url, headers, session)
+
+    async with session.delete(url, headers=headers) as response:
+        return await response.json(loads=json_loads)
+
+
+# synchronous_http_request tries this many times when the request wasn't
+# handled: it couldn't connect, or the server was rate limiting or unavailable.
+# Other errors may mean the request went through, e.g. a comment was posted.
+# urllib raises URLError for failures after the request was sent too, so only
+# failures to resolve the host or open a connection are retried.
+http_request_attempts = 3
+http_retry_statuses = (429, 503)
+http_retry_reasons = (ConnectionRefusedError, socket.gaierror)
+# Never wait longer than this between attempts, in seconds, whatever the
+# server's Retry-After says.
+http_retry_max_delay = 60
+
+_http_opener = build_opener(HTTPHandler)
 
 
 def synchronous_http_request(url, data=None, token=None):
@@ -245,7 +360,7 @@ def synchronous_http_request(url, data=None, token=None):
         headers["Authorization"] = f"Bearer {token}"
 
     if data:
-        data = json.dumps(data).encode("utf-8")
+        data = json_dumps_bytes(data)
 
     request = Request(
         url,
@@ -253,8 +368,30 @@ def synchronous_http_request(url, data=None, token=None):
         headers=headers,
     )
 
-    opener = build_opener(HTTPHandler)
-    response = opener.open(request)
+    for attempt in range(1, http_request_attempts + 1):
+        try:
+            response = _http_opener.open(request)
+            break
+        except HTTPError as e:
+            if e.code not in http_retry_statuses or attempt == http_request_attempts:
+                raise
+            retry_after = e.headers.get("Retry-After", "")
+        except URLError as e:
+            if (
+                not isinstance(e.reason, http_retry_reasons)
+                or attempt == http_request_attempts
+            ):
+                raise
+            retry_after = ""
+
+        # Back off exponentially with jitter, unless the server says how long
+        if retry_after.isdigit():
+            delay = min(int(retry_after), http_retry_max_delay)
+        else:
+            delay = 2**attempt * (1 + random.random())
+        logger.warning(f"Request to {url} failed, retrying in {delay:.0f}s")
+        time.sleep(delay)
+
     response_code = response.getcode()
 
     logger.debug(
@@ -265,20 +402,16 @@ def synchronous_http_request(url, data=None, token=None):
 
 
 def s3_parse_url(url, default_bucket="spack-binaries-prs", default_prefix="dummy"):
-    parsed = {
-        "bucket": default_bucket,
-        "prefix": default_prefix,
-    }
-
     if isinstance(url, str):
         url = urlparse(url)
 
     if url.scheme == "s3":
-        parsed.update(
-            {
-                "bucket": url.netloc,
-                "prefix": url.path.strip("/"),
-            }
-        )
+        return {
+            "bucket": url.netloc,
+            "prefix": url.path.strip("/"),
+        }
 
-    return parsed
+    return {
+        "bucket": default_bucket,
+        "prefix": default_prefix,
+    }
@@ -17,6 +17,28 @@ from typing import Any
 
 logger = helpers.get_logger(__name__)
 
+# The commands spackbot responds to in comments, as one pattern so a comment is
+# scanned once. The group that matched names the command.
+command_regex = re.compile(
+    re.escape(helpers.botname)
+    + " (?:"
+    + "|".join(
+        (
+            "(?P<hello>hello)",
+            "(?P<fix_style>fix style)",
+            "(?P<help>commands|help)",
+            "(?P<maintainers>maintainers|request review)",
+            "(?P<run_pipeline>(?:re-?)?run pipeline)",
+            "(?P<rebuild_everything>rebuild everything)",
+        )
+    )
+    + ")",
+    re.IGNORECASE,
+)
+
+# Every command and the joke request mention the bot, in some case
+_botname_folded = helpers.botname.casefold()
+
 
 class SpackbotRouter(routing.Router):
 
@@ -27,13 +49,9 @@ class SpackbotRouter(routing.Router):
     async def dispatch(self, event: sansio.Event, *args: Any, **kwargs: Any) -> None:
         """Dispatch an event to all registered function(s)."""
 
-        # if we haven't retrieved package list yet, do so
-        if not hasattr(self, "packages"):
-            self.packages = await helpers.list_packages()
-
         # for all endpoints, spackbot should not respond to himself!
-        if "comment" in event.data and re.search(
-            helpers.alias_regex, event.data["comment"]["user"]["login"]
+        if "comment" in event.data and helpers.alias_regex.search(
+            event.data["comment"]["user"]["login"]
         ):
             return
 
@@ -67,7 +85,7 @@ async def on_pull_request(event, gh, *args, session, **kwargs):
     """
     Respond to the pull request being opened
     """
-    await handlers.add_reviewers(event, gh)
+    await handlers.add_reviewers(event, gh, session)
 
 
 @router.register("issue_comment", action="created")
@@ -82,40 +100,45 @@ async def add_comments(event, gh, *args, session, **kwargs):
     # Respond with appropriate messages
     comment = event.data["comment"]["body"]
 
+    # Most comments aren't for spackbot; don't look for commands in those
+    if _botname_folded not in comment.casefold():
+        return
+
+    # Find every command in the comment, and respond to the first one below
+    commands = {match.lastgroup for match in command_regex.finditer(comment)}
+
     # @spackbot hello
     message = None
-    if re.search(f"{helpers.botname} hello", comment, re.IGNORECASE):
+    if "hello" in commands:
         logger.info(f"Responding to hello message {comment}...")
         message = comments.say_hello()
 
     # Hey @spackbot tell me a joke!
     elif helpers.botname in comment and "joke" in comment:
         logger.info(f"Responding to request for joke {comment}...")
-        message = await comments.tell_joke(gh)
+        message = await comments.tell_joke(session)
 
-    elif re.search(f"{helpers.botname} fix style", comment, re.IGNORECASE):
+    elif "fix_style" in commands:
         logger.debug("Responding to request to fix style")
         message = await handlers.fix_style(event, gh, *args, **kwargs)
 
     # @spackbot commands OR @spackbot help
-    elif re.search(f"{helpers.botname} (commands|help)", comment, re.IGNORECASE):
+    elif "help" in commands:
         logger.debug("Responding to request for help commands.")
         message = comments.commands_message
 
     # @spackbot maintainers or @spackbot request review
-    elif re.search(
-        f"{helpers.botname} (maintainers|request review)", comment, re.IGNORECASE
-    ):
+    elif "maintainers" in commands:
         logger.debug("Responding to request to assign maintainers for review.")
-        await handlers.add_reviewers(event, gh)
+        await handlers.add_reviewers(event, gh, session)
 
     # @spackbot run pipeline | @spackbot re-run pipeline
-    elif re.search(f"{helpers.botname} (re-?)?run pipeline", comment, re.IGNORECASE):
+    elif "run_pipeline" in commands:
         logger.info("Responding to request to re-run pipeline...")
         await handlers.run_pipeline(event, gh, **kwargs)
 
     # @spackbot rebuild everything
-    elif re.search(f"{helpers.botname} rebuild everything", comment, re.IGNORECASE):
+    elif "rebuild_everything" in commands:
         logger.info("Responding to request to rebuild everthing...")
         await handlers.run_pipeline_rebuild_all(event, gh, **kwargs)
 
@@ -137,6 +160,6 @@ async def on_closed_pull_request(event, gh, *args, session, **kwargs):
     """
     Respond to the pull request closed
     """
-    await handlers.close_pr_gitlab_branch(event, gh)
+    await handlers.close_pr_gitlab_branch(event, gh, session)
 
     await handlers.close_pr_mirror(event, gh)
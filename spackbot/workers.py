@@ -3,7 +3,13 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import asyncio
+import contextlib
+import fcntl
 import os
+import shutil
+import string
+import tempfile
 import urllib.parse
 
 import aiohttp
@@ -16,6 +22,7 @@ from sh.contrib import git
 import sh
 
 from redis import Redis
+from redis.exceptions import LockNotOwnedError
 from rq import get_current_job, Queue
 
 import spackbot.comments as comments
@@ -44,6 +51,38 @@ allow_edits_url = (
     "#enabling-repository-maintainer-permissions-on-existing-pull-requests"
 )
 
+#: What fix_style_task adds after the spack style output, depending on how it went
+style_no_changes_note = "\nI wasn't able to make any further changes, but please see the message above for remaining issues you can fix locally!"
+style_updated_note = "\n\nI've updated the branch with style fixes."
+style_push_failed_note = (
+    "\n\nBut it looks like I'm not able to push to your branch. 😭️"
+    f" Did you check [Allow edits from maintainers]({allow_edits_url})"
+    " when you opened the PR?"
+)
+
+#: Pipeline variables for a rebuild everything request (see run_pipeline_task)
+rebuild_everything_variables = {
+    "SPACK_PRUNE_UNTOUCHED": "False",
+    "SPACK_PRUNE_UP_TO_DATE": "False",
+    "PIPELINE_MIRROR_TEMPLATE": "single-src-pr-mirrors.yaml.in",
+}
+
+#: The same variables, as query parameters for the GitLab pipeline API
+rebuild_everything_query = "".join(
+    f"&variables[][key]={key}&variables[][value]={urllib.parse.quote_plus(value)}"
+    for key, value in rebuild_everything_variables.items()
+)
+
+#: Characters urllib.parse.quote_plus never escapes
+url_safe_chars = frozenset(string.ascii_letters + string.digits + "_.-~")
+
+
+def quote_plus(value):
+    """urllib.parse.quote_plus, skipping the work if nothing needs quoting."""
+    if url_safe_chars.issuperset(value):
+        return value
+    return urllib.parse.quote_plus(value)
+
 
 def get_queue(name):
     return Queue(name=name, connection=redis)
@@ -56,7 +95,9 @@ def is_up_to_date(output):
     return "nothing to commit" in output
 
 
-async def check_gitlab_has_latest(branch_name, pr_head_sha, gh, comments_url):
+async def check_gitlab_has_latest(
+    branch_name, pr_head_sha, gh, comments_url, session=None
+):
     """
     Given the name of the branch supposedly pushed to gitlab, check if it
     is the latest revision found on github.  If gitlab doesn't have the
@@ -68,13 +109,14 @@ async def check_gitlab_has_latest(branch_name, pr_head_sha, gh, comments_url):
         pr_head_sha (str): SHA of PR head from GitHub
         gh: GitHubAPI object for posting comments on the PR
         comments_url (str): URL to post any error message to
+        session: optional aiohttp.ClientSession to reuse for the GitLab request
 
     Returns: True if gitlab has the latest revsion, False otherwise.
     """
     # Get the commit for the PR branch from GitLab to see what's been pushed there
     headers = {"PRIVATE-TOKEN": GITLAB_TOKEN}
     commit_url = f"{helpers.gitlab_spack_project_url}/repository/commits/{branch_name}"
-    gitlab_commit = await helpers.get(commit_url, headers)
+    gitlab_commit = await helpers.get(commit_url, headers, session)
 
     error_msg = comments.cannot_run_pipeline_comment
 
@@ -162,14 +204,12 @@ async def run_pipeline_task(event):
         pr_url = event.data["issue"]["pull_request"]["url"]
         *_, number = pr_url.split("/")
 
-        # We need the pull request branch
-        pr = await gh.getitem(pr_url)
-
-        # Get the sender of the PR - do they have write?
+        # Get the sender of the PR - do they have write? The issue of a PR
+        # comment is the PR itself, so we know the author without fetching it.
         sender = event.data["sender"]["login"]
         repository = event.data["repository"]
         collaborators_url = repository["collaborators_url"]
-        author = pr["user"]["login"]
+        author = event.data["issue"]["user"]["login"]
 
         # If it's the PR author, we allow it
         if author == sender:
@@ -177,24 +217,34 @@ async def run_pipeline_task(event):
                 f"Author {author} of PR #{number} is requesting a pipeline run."
             )
 
-        # If they don't have write, we don't allow the command
-        elif not await helpers.found(
-            gh.getitem(collaborators_url, {"collaborator": sender})
-        ):
-            logger.info(f"Not found: {sender}")
-            msg = f"Sorry {sender}, I cannot do that for you. Only users with write can make this request!"
-            await gh.post(comments_url, {}, data={"body": msg})
-            return
+            # We need the pull request branch
+            pr = await gh.getitem(pr_url)
+
+        else:
+            # Fetch the pull request while checking for write
+            pr, is_collaborator = await asyncio.gather(
+                gh.getitem(pr_url),
+                helpers.found(gh.getitem(collaborators_url, {"collaborator": sender})),
+            )
+
+            # If they don't have write, we don't allow the command
+            if not is_collaborator:
+                logger.info(f"Not found: {sender}")
+                msg = f"Sorry {sender}, I cannot do that for you. Only users with write can make this request!"
+                await gh.post(comments_url, {}, data={"body": msg})
+                return
 
         # We need the branch name plus number to assemble the GitLab CI api requests
         branch = pr["head"]["ref"]
         pr_mirror_key = f"pr{number}_{branch}"
-        branch = urllib.parse.quote_plus(pr_mirror_key)
+        branch = quote_plus(pr_mirror_key)
 
         # If gitlab doesn't have the latest PR head sha from GitHub, we can't run the
         # pipeline.
         head_sha = pr["head"]["sha"]
-        if not await check_gitlab_has_latest(branch, head_sha, gh, comments_url):
+        if not await check_gitlab_has_latest(
+            branch, head_sha, gh, comments_url, session
+        ):
             return
 
         url = f"{helpers.gitlab_spack_project_url}/pipeline?ref={branch}"
@@ -211,12 +261,7 @@ async def run_pipeline_task(event):
             #
             #    https://gitlab.com/gitlab-org/gitlab/-/issues/23394
             #
-            url = (
-                f"{url}&variables[][key]=SPACK_PRUNE_UNTOUCHED&variables[][value]=False"
-            )
-            url = f"{url}&variables[][key]=SPACK_PRUNE_UP_TO_DATE&variables[][value]=False"
-            mirror_template = urllib.parse.quote_plus("single-src-pr-mirrors.yaml.in")
-            url = f"{url}&variables[][key]=PIPELINE_MIRROR_TEMPLATE&variables[][value]={mirror_template}"
+            url = f"{url}{rebuild_everything_query}"
 
             logger.info(
                 f"Deleting {helpers.pr_mirror_base_url}/{pr_mirror_key} for rebuild request by {sender}"
@@ -230,11 +275,11 @@ async def run_pipeline_task(event):
             bucket = s3.Bucket(pr_url.get("bucket"))
             bucket.objects.filter(Prefix=pr_url.get("prefix")).delete()
 
-        # Use helpers.post because it creates a new session (and here we are
-        # communicating with gitlab rather than github).
+        # Use helpers.post rather than gh, since here we are communicating with
+        # gitlab rather than github, but reuse this job's session.
         headers = {"PRIVATE-TOKEN": GITLAB_TOKEN}
         logger.info(f"{sender} triggering pipeline, url = {url}")
-        result = await helpers.post(url, headers)
+        result = await helpers.post(url, headers, session)
 
         detailed_status = result.get("detailed_status", {})
         if "details_path" in detailed_status:
@@ -263,133 +308,215 @@ async def fix_style_task(event):
     async with aiohttp.ClientSession() as session:
         gh = gh_aiohttp.GitHubAPI(session, REQUESTER, oauth_token=token)
 
-        pr_url = event.data["issue"]["pull_request"]["url"]
-
-        pr = await gh.getitem(pr_url)
-
-        logger.debug("GitHub PR")
-        logger.debug(pr)
+        issue = event.data["issue"]
+        pr_url = issue["pull_request"]["url"]
+        comments_url = issue["comments_url"]
 
-        # Get the sender of the PR - do they have write?
+        # Get the sender of the PR - do they have write? The issue of a PR
+        # comment is the PR itself, so we know the author without fetching it.
         sender = event.data["sender"]["login"]
         repository = event.data["repository"]
         collaborators_url = repository["collaborators_url"]
-        author = pr["user"]["login"]
+        author = issue["user"]["login"]
 
         logger.debug(
             f"sender = {sender}, repo = {repository}, collabs_url = {collaborators_url}"
         )
 
+        # The PR author can always ask. Otherwise, fetch the pull request while
+        # checking for write.
+        if sender == author:
+            pr = await gh.getitem(pr_url)
+            is_collaborator = True
+        else:
+            pr, is_collaborator = await asyncio.gather(
+                gh.getitem(pr_url),
+                helpers.found(gh.getitem(collaborators_url, {"collaborator": sender})),
+            )
+
+        logger.debug("GitHub PR")
+        logger.debug(pr)
+
         # If they didn't create the PR and don't have write, we don't allow the command
-        if sender != author and not await helpers.found(
-            gh.getitem(collaborators_url, {"collaborator": sender})
-        ):
+        if not is_collaborator:
             msg = f"Sorry {sender}, I cannot do that for you. Only {author} and users with write can make this request!"
-            await gh.post(event.data["issue"]["comments_url"], {}, data={"body": msg})
+            await gh.post(comments_url, {}, data={"body": msg})
             return
 
-        # Tell the user the style fix is going to take a minute or two
-        message = "Let me see if I can fix that for you!"
-        await gh.post(event.data["issue"]["comments_url"], {}, data={"body": message})
-
-        # Get the username of the original committer
-        user = pr["user"]["login"]
-
-        # We need the user id if the user is before July 18, 2017.  See note about why
-        # here:
-        #
-        #     https://docs.github.com/en/account-and-profile/setting-up-and-managing-your-personal-account-on-github/managing-email-preferences/setting-your-commit-email-address
-        #
-        email = await helpers.get_user_email(gh, user)
-
-        # We need to use the git url with ssh
-        remote_branch = pr["head"]["ref"]
-        local_branch = "spackbot-style-check-working-branch"
-        full_name = pr["head"]["repo"]["full_name"]
-        fork_url = f"git@github.com:{full_name}.git"
-
-        logger.info(
-            f"fix_style_task, user = {user}, email = {email}, fork = {fork_url}, branch = {remote_branch}\n"
+        # Only fix style on a branch once at a time, or the pushes could race
+        head = pr["head"]
+        branch_lock = redis.lock(
+            f"fix-style:{head['repo']['full_name']}:{head['ref']}",
+            timeout=WORKER_JOB_TIMEOUT,
         )
+        if not branch_lock.acquire(blocking=False):
+            msg = "I'm already fixing style on this branch, hang on until I'm done!"
+            await gh.post(comments_url, {}, data={"body": msg})
+            return
 
-        # At this point, we can clone the repository and make the change
-        with helpers.temp_dir() as cwd:
-            # Clone a fresh spack develop to use for spack style
-            git.clone(helpers.spack_upstream, "spack-develop")
+        try:
+            # Tell the user the style fix is going to take a minute or two
+            message = "Let me see if I can fix that for you!"
+            await gh.post(comments_url, {}, data={"body": message})
 
-            spack = sh.Command(f"{cwd}/spack-develop/bin/spack")
+            # Commit as the original committer, the PR author
+            user = author
 
-            # clone the develop repository to another folder for our PR
-            git.clone("spack-develop", "spack")
+            # We need the user id if the user is before July 18, 2017.  See note about why
+            # here:
+            #
+            #     https://docs.github.com/en/account-and-profile/setting-up-and-managing-your-personal-account-on-github/managing-email-preferences/setting-your-commit-email-address
+            #
+            email = await helpers.get_user_email(gh, user)
 
-            os.chdir("spack")
+            # We need to use the git url with ssh
+            remote_branch = head["ref"]
+            full_name = head["repo"]["full_name"]
+            fork_url = f"git@github.com:{full_name}.git"
 
-            git.config("user.name", user)
-            git.config("user.email", email)
+            logger.info(
+                f"fix_style_task, user = {user}, email = {email}, fork = {fork_url}, branch = {remote_branch}\n"
+            )
 
-            # This will authenticate the push with the added ssh credentials
-            git.remote("add", "upstream", helpers.spack_upstream)
-            git.remote("set-url", "origin", fork_url)
+            # spack style only looks at the files the PR changes (and spack's own
+            # code, for mypy), so only check those directories out. If the PR
+            # changes more files than GitHub will list, check out everything.
+            sparse_paths = None
+            if pr["changed_files"] <= (
+                helpers.pr_files_per_page * helpers.pr_files_max_pages
+            ):
+                sparse_paths = {"lib/spack"}
+                for file in await helpers.list_pr_files(gh, pr):
+                    if file["status"] != "removed":
+                        sparse_paths.add(os.path.dirname(file["filename"]))
+                # Files at the top level are always checked out
+                sparse_paths.discard("")
+
+            # At this point, we can clone the repository and make the change
+            with contextlib.ExitStack() as stack:
+                cwd = stack.enter_context(helpers.temp_dir())
+                mirror_dir = stack.enter_context(spack_mirror())
+
+                # Use the kept clone of spack develop to run spack style
+                spack_root = stack.enter_context(spack_base_clone())
+                spack = sh.Command(f"{spack_root}/bin/spack")
+
+                # Clone just the PR branch from the fork, borrowing objects from the
+                # spack mirror, so only the PR branch's own commits are fetched.
+                # Of those, only blobs the checkout needs are downloaded, and no
+                # tags, which we never read. It's checked out below.
+                # The commit identity and upstream remote are written as part of
+                # the clone, rather than with a git process each afterwards. Using
+                # the ssh url authenticates the push with the added ssh credentials.
+                check_dir = f"{cwd}/spack"
+                helpers.run_command(
+                    git,
+                    [
+                        "clone",
+                        "--no-checkout",
+                        "--reference",
+                        mirror_dir,
+                        "--single-branch",
+                        "--no-tags",
+                        "--filter=blob:none",
+                        "--branch",
+                        remote_branch,
+                        "-c",
+                        f"user.name={user}",
+                        "-c",
+                        f"user.email={email}",
+                        "-c",
+                        f"remote.upstream.url={helpers.spack_upstream}",
+                        "-c",
+                        "remote.upstream.fetch=+refs/heads/*:refs/remotes/upstream/*",
+                        fork_url,
+                        check_dir,
+                    ],
+                )
 
-            # we're on upstream/develop. Fetch just the PR branch
-            helpers.run_command(
-                git, ["fetch", "origin", f"{remote_branch}:{local_branch}"]
-            )
+                # Run commands in the PR clone without changing directory
+                pr_git = git.bake("-C", check_dir)
 
-            # check out the PR branch
-            helpers.run_command(git, ["checkout", local_branch])
+                if sparse_paths:
+                    helpers.run_command(pr_git, ["sparse-checkout", "init", "--cone"])
+                    helpers.run_command(
+                        pr_git, ["sparse-checkout", "set", *sorted(sparse_paths)]
+                    )
+                helpers.run_command(pr_git, ["checkout", remote_branch])
 
-            # Run the style check and save the message for the user
-            check_dir = os.getcwd()
-            res, err = helpers.run_command(
-                spack, ["--color", "never", "style", "--fix", "--root", check_dir]
-            )
-            logger.debug("spack style [output]")
-            logger.debug(res)
-            logger.debug("spack style [error]")
-            logger.debug(err)
-
-            message = comments.get_style_message(res)
-
-            # Commit (allow for no changes)
-            res, err = helpers.run_command(
-                git,
-                [
-                    "commit",
-                    "-a",
-                    "-m",
-                    f"[{helpers.botname}] updating style on behalf of {user}",
-                ],
-            )
+                # spack style compares against develop. Its objects are all in the
+                # mirror, so this only writes the ref. It can't be a local branch,
+                # since the PR branch may be called develop too.
+                helpers.run_command(
+                    pr_git,
+                    ["fetch", mirror_dir, "develop:refs/remotes/upstream/develop"],
+                )
 
-            # Continue differently if the branch is up to date or not
-            if is_up_to_date(res):
-                logger.info("Unable to make any further changes")
-                message += "\nI wasn't able to make any further changes, but please see the message above for remaining issues you can fix locally!"
-                await gh.post(
-                    event.data["issue"]["comments_url"], {}, data={"body": message}
+                # Run the style check (from the PR clone) and save the message for
+                # the user
+                res, err = helpers.run_command(
+                    spack.bake(_cwd=check_dir),
+                    [
+                        "--color",
+                        "never",
+                        "style",
+                        "--fix",
+                        "--root",
+                        check_dir,
+                        "--base",
+                        "upstream/develop",
+                    ],
+                    # The message only shows this much of the output
+                    limit=comments.style_output_limit,
                 )
-                return
+                logger.debug("spack style [output]")
+                logger.debug(res)
+                logger.debug("spack style [error]")
+                logger.debug(err)
+
+                # Put the reply together once we know how it went
+                parts = [comments.get_style_message(res)]
+
+                # Commit (allow for no changes)
+                res, err = helpers.run_command(
+                    pr_git,
+                    [
+                        "commit",
+                        "-a",
+                        "-m",
+                        f"[{helpers.botname}] updating style on behalf of {user}",
+                    ],
+                )
+
+                # Continue differently if the branch is up to date or not
+                if is_up_to_date(res):
+                    logger.info("Unable to make any further changes")
+                    parts.append(style_no_changes_note)
+                    await gh.post(comments_url, {}, data={"body": "".join(parts)})
+                    return
 
-            message += "\n\nI've updated the branch with style fixes."
+                parts.append(style_updated_note)
 
-            # Finally, try to push, update the message if permission not allowed
+                # Finally, try to push, update the message if permission not allowed
+                try:
+                    helpers.run_command(
+                        pr_git, ["push", "origin", f"HEAD:{remote_branch}"]
+                    )
+                except Exception:
+                    logger.error("Unable to push to branch")
+                    parts.append(style_push_failed_note)
+
+                await gh.post(comments_url, {}, data={"body": "".join(parts)})
+        finally:
             try:
-                helpers.run_command(
-                    git, ["push", "origin", f"{local_branch}:{remote_branch}"]
-                )
-            except Exception:
-                logger.error("Unable to push to branch")
-                message += (
-                    f"\n\nBut it looks like I'm not able to push to your branch. 😭️"
-                    f" Did you check [Allow edits from maintainers]({allow_edits_url})"
-                    f" when you opened the PR?"
+                branch_lock.release()
+            except LockNotOwnedError:
+                # The job ran past the lock's timeout; don't hide its outcome
+                logger.warning(
+                    f"Style fix lock for {head['repo']['full_name']}:{head['ref']} "
+                    "expired before the job finished"
                 )
 
-            await gh.post(
-                event.data["issue"]["comments_url"], {}, data={"body": message}
-            )
-
 
 async def copy_pr_mirror(pr_mirror_url, shared_pr_mirror_url):
     """Copy between the S3 per-pr mirror and the shared pr mirror.
@@ -455,6 +582,10 @@ def list_ci_stacks(spack_root):
             yield stack
 
 
+#: A spack hash: 32 chars long between a "-" and a "."
+hash_regex = re.compile(r"-([a-zA-Z0-9]{32,32})\.")
+
+
 def hash_from_key(key):
     """This works because we guarentee the hash is in the key string.
     If this assumption is ever broken, this code will break.
@@ -468,7 +599,7 @@ def hash_from_key(key):
     # examples include:
     # linux-ubuntu18.04-x86_64-gcc-8.4.0-armadillo-10.5.0-gq3ijjrtnzgpm4bvuamjr6wa7hzxkypz.spack
     # linux-ubuntu18.04-x86_64-gcc-8.4.0-armadillo-10.5.0-gq3ijjrtnzgpm4bvuamjr6wa7hzxkypz.spec.json
-    h = re.findall(r"-([a-zA-Z0-9]{32,32})\.", key.lower())
+    h = hash_regex.findall(key.lower())
     if len(h) > 1:
         # Error, multiple matches are ambigious
         h = None
@@ -490,11 +621,15 @@ def check_skip_job(job=None):
     job_type = job.meta.get("type", "-")
     skip = False
     logger.debug(f"-- Checking skip job({job.id}): {job_type}")
-    # Check if another job of this type is queued
+    # Check if another job of this type is queued. Checking the length of
+    # the queue is cheap, so only fetch the queued jobs if there are any.
     queue = get_queue(job.origin)
+    if queue.count == 0:
+        return False
+
     for _job in queue.jobs:
         _job_type = _job.meta["type"]
-        logger.debug(f"-- job({_job.id}): {_job_type}")
+        logger.debug("-- job(%s): %s", _job.id, _job_type)
         if _job.meta["type"] == job_type:
             skip = True
             break
@@ -508,6 +643,227 @@ def check_skip_job(job=None):
     return skip
 
 
+def prune_stack_mirror_duplicates(s3, shared_pr_mirror_url, publish_mirror_url):
+    """Prune objects from one stack's S3 mirror for shared PR binaries that have
+    been published to the develop mirror or have expired.
+
+        Parameters:
+            s3                                : boto3 S3 resource
+            shared_pr_mirror_url (string): URL to stack S3 mirror for shared PR binaries
+            publish_mirror_url   (string): URL to stack S3 mirror for published binaries
+    """
+    shared_pr_url = helpers.s3_parse_url(shared_pr_mirror_url)
+    shared_pr_bucket_name = shared_pr_url.get("bucket")
+    shared_pr_bucket = s3.Bucket(shared_pr_bucket_name)
+    shared_pr_mirror_prefix = shared_pr_url.get("prefix")
+
+    publish_url = helpers.s3_parse_url(publish_mirror_url)
+    publish_bucket = s3.Bucket(publish_url.get("bucket"))
+    publish_mirror_prefix = publish_url.get("prefix")
+
+    # All of the expected possible spec file extensions
+    extensions = (".spec.json", ".spec.yaml", ".spec.json.sig")
+
+    # Get the current time for age based pruning
+    now = datetime.now()
+    delete_specs = set()
+    shared_pr_specs = set()
+    for obj in shared_pr_bucket.objects.filter(
+        Prefix=shared_pr_mirror_prefix,
+    ):
+        # Need to convert from aware to naive time to get delta
+        last_modified = obj.last_modified.replace(tzinfo=None)
+        # Prune obj.last_modified > helpers.shared_pr_mirror_retire_after_days
+        # (default: 7) days to avoid storing cached objects that only
+        # existed during development.
+        # Anything older than the retirement age should just be indesciminately
+        # pruned
+        if (now - last_modified).days >= helpers.shared_pr_mirror_retire_after_days:
+            logger.debug(
+                "pr mirror pruning %s from s3://%s: reason(age)",
+                obj.key,
+                shared_pr_bucket_name,
+            )
+            obj.delete()
+
+            # Grab the hash from the object, to ensure all of the files associated with
+            # it are also removed.
+            spec_hash = hash_from_key(obj.key)
+            if spec_hash:
+                delete_specs.add(spec_hash)
+            continue
+
+        if not obj.key.endswith(extensions):
+            continue
+
+        # Get the hashes in the shared PR bucket.
+        spec_hash = hash_from_key(obj.key)
+        if spec_hash:
+            shared_pr_specs.add(spec_hash)
+        else:
+            logger.error(f"Encountered spec file without hash in name: {obj.key}")
+
+    # Check in the published base branch bucket for duplicates to delete
+    for obj in publish_bucket.objects.filter(
+        Prefix=publish_mirror_prefix,
+    ):
+        if not obj.key.endswith(extensions):
+            continue
+
+        spec_hash = hash_from_key(obj.key.lower())
+        if spec_hash in shared_pr_specs:
+            delete_specs.add(spec_hash)
+
+    # Also look at the .spack files for deletion
+    extensions = (".spack", *extensions)
+
+    # Delete all of the objects with marked hashes
+    for obj in shared_pr_bucket.objects.filter(
+        Prefix=shared_pr_mirror_prefix,
+    ):
+        if not obj.key.endswith(extensions):
+            continue
+
+        if hash_from_key(obj.key) in delete_specs:
+            logger.debug(
+                "pr mirror pruning %s from s3://%s: reason(published)",
+                obj.key,
+                shared_pr_bucket_name,
+            )
+            obj.delete()
+
+
+def update_stack_mirror_index(spack, stack_mirror_url):
+    """Use spack buildcache command to update index for one stack mirror.
+
+    Parameters:
+        spack                      : sh.Command for the spack executable
+        stack_mirror_url (string): URL to the stack S3 mirror
+    """
+    print(f"Updating binary index at {stack_mirror_url}")
+    helpers.run_command(
+        spack,
+        [
+            "-d",
+            "buildcache",
+            "update-index",
+            f"{stack_mirror_url}",
+        ],
+    )
+
+
+#: The parts of spack the kept clone needs: spack itself, its default config, the
+#: CI stacks, and the builtin repo, which spack expects to find when it starts
+#: up to run a command like spack style. Tests, docs and other repos are left out.
+spack_base_sparse_paths = (
+    "bin",
+    "lib",
+    "etc",
+    "share/spack",
+    "var/spack/repos/builtin",
+)
+
+
+def clone_spack_base(dest):
+    """Shallow, sparse clone of the expected base branch of spack into dest."""
+    git.clone(
+        "--branch",
+        helpers.pr_expected_base,
+        "--depth",
+        1,
+        "--filter=blob:none",
+        "--sparse",
+        helpers.spack_upstream,
+        dest,
+    )
+    git("-C", dest, "sparse-checkout", "init", "--cone")
+    git("-C", dest, "sparse-checkout", "set", *spack_base_sparse_paths)
+
+
+#: Where the mirror jobs keep their clone of spack between jobs
+spack_base_clone_dir = os.path.join(tempfile.gettempdir(), "spackbot-spack-base")
+
+
+@contextlib.contextmanager
+def spack_base_clone():
+    """
+    Yield the path to an up to date clone of the expected base branch of spack.
+
+    The clone is kept between jobs and only fetched and reset each time. It is
+    only updated once no other worker process on this host is using it.
+    """
+    with open(f"{spack_base_clone_dir}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            git(
+                "-C",
+                spack_base_clone_dir,
+                "fetch",
+                "--depth",
+                1,
+                "origin",
+                helpers.pr_expected_base,
+            )
+            git("-C", spack_base_clone_dir, "reset", "--hard", "FETCH_HEAD")
+            # In case the clone was made with different paths
+            git(
+                "-C",
+                spack_base_clone_dir,
+                "sparse-checkout",
+                "set",
+                *spack_base_sparse_paths,
+            )
+            git("-C", spack_base_clone_dir, "clean", "-ffdx")
+        except sh.ErrorReturnCode:
+            # No clone yet, or it's broken: start over
+            shutil.rmtree(spack_base_clone_dir, ignore_errors=True)
+            clone_spack_base(spack_base_clone_dir)
+
+        # Jobs only read the clone, so let other jobs use it at the same time
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+        yield spack_base_clone_dir
+
+
+#: Where workers keep a bare mirror of spack, so jobs that need its full history
+#: only fetch what changed since the last job
+spack_mirror_dir = os.path.join(tempfile.gettempdir(), "spackbot-spack.git")
+
+
+@contextlib.contextmanager
+def spack_mirror():
+    """
+    Yield the path to a local bare mirror of spack upstream, after bringing it
+    up to date (or creating it).
+
+    Jobs can borrow objects from the mirror while they hold it, so it is only
+    updated once no other worker process on this host is using it.
+    """
+    with open(f"{spack_mirror_dir}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            git("-C", spack_mirror_dir, "fetch", "--prune", "origin")
+        except sh.ErrorReturnCode:
+            # No mirror yet, or it's broken: start over. Only mirror branches;
+            # a --mirror clone from GitHub would also fetch every PR's head.
+            shutil.rmtree(spack_mirror_dir, ignore_errors=True)
+            git.clone("--bare", helpers.spack_upstream, spack_mirror_dir)
+            git(
+                "-C",
+                spack_mirror_dir,
+                "config",
+                "remote.origin.fetch",
+                "+refs/heads/*:refs/heads/*",
+            )
+
+        # Let other jobs read the mirror too while this one uses it
+        fcntl.flock(lock, fcntl.LOCK_SH)
+
+        yield spack_mirror_dir
+
+
 # Prune per stack mirror
 async def prune_mirror_duplicates(shared_pr_mirror_url, publish_mirror_url):
     """Prune objects from the S3 mirror for shared PR binaries that have been published to the
@@ -524,102 +880,13 @@ async def prune_mirror_duplicates(shared_pr_mirror_url, publish_mirror_url):
 
     s3 = boto3.resource("s3")
 
-    with helpers.temp_dir() as cwd:
-        git.clone(
-            "--branch",
-            helpers.pr_expected_base,
-            "--depth",
-            1,
-            helpers.spack_upstream,
-            "spack",
-        )
-
-        for stack in list_ci_stacks(f"{cwd}/spack"):
-            shared_pr_url = helpers.s3_parse_url(
-                shared_pr_mirror_url.format_map({"stack": stack})
+    with spack_base_clone() as spack_root:
+        for stack in list_ci_stacks(spack_root):
+            prune_stack_mirror_duplicates(
+                s3,
+                shared_pr_mirror_url.format_map({"stack": stack}),
+                publish_mirror_url.format_map({"stack": stack}),
             )
-            shared_pr_bucket_name = shared_pr_url.get("bucket")
-            shared_pr_bucket = s3.Bucket(shared_pr_bucket_name)
-            shared_pr_mirror_prefix = shared_pr_url.get("prefix")
-
-            publish_url = helpers.s3_parse_url(
-                publish_mirror_url.format_map({"stack": stack})
-            )
-            publish_bucket = s3.Bucket(publish_url.get("bucket"))
-            publish_mirror_prefix = publish_url.get("prefix")
-
-            # All of the expected possible spec file extensions
-            extensions = (".spec.json", ".spec.yaml", ".spec.json.sig")
-
-            # Get the current time for age based pruning
-            now = datetime.now()
-            delete_specs = set()
-            shared_pr_specs = set()
-            for obj in shared_pr_bucket.objects.filter(
-                Prefix=shared_pr_mirror_prefix,
-            ):
-                # Need to convert from aware to naive time to get delta
-                last_modified = obj.last_modified.replace(tzinfo=None)
-                # Prune obj.last_modified > helpers.shared_pr_mirror_retire_after_days
-                # (default: 7) days to avoid storing cached objects that only
-                # existed during development.
-                # Anything older than the retirement age should just be indesciminately
-                # pruned
-                if (
-                    now - last_modified
-                ).days >= helpers.shared_pr_mirror_retire_after_days:
-                    logger.debug(
-                        f"pr mirror pruning {obj.key} from s3://{shared_pr_bucket_name}: "
-                        "reason(age)"
-                    )
-                    obj.delete()
-
-                    # Grab the hash from the object, to ensure all of the files associated with
-                    # it are also removed.
-                    spec_hash = hash_from_key(obj.key)
-                    if spec_hash:
-                        delete_specs.add(spec_hash)
-                    continue
-
-                if not obj.key.endswith(extensions):
-                    continue
-
-                # Get the hashes in the shared PR bucket.
-                spec_hash = hash_from_key(obj.key)
-                if spec_hash:
-                    shared_pr_specs.add(spec_hash)
-                else:
-                    logger.error(
-                        f"Encountered spec file without hash in name: {obj.key}"
-                    )
-
-            # Check in the published base branch bucket for duplicates to delete
-            for obj in publish_bucket.objects.filter(
-                Prefix=publish_mirror_prefix,
-            ):
-                if not obj.key.endswith(extensions):
-                    continue
-
-                spec_hash = hash_from_key(obj.key.lower())
-                if spec_hash in shared_pr_specs:
-                    delete_specs.add(spec_hash)
-
-            # Also look at the .spack files for deletion
-            extensions = (".spack", *extensions)
-
-            # Delete all of the objects with marked hashes
-            for obj in shared_pr_bucket.objects.filter(
-                Prefix=shared_pr_mirror_prefix,
-            ):
-                if not obj.key.endswith(extensions):
-                    continue
-
-                if hash_from_key(obj.key) in delete_specs:
-                    logger.debug(
-                        f"pr mirror pruning {obj.key} from s3://{shared_pr_bucket_name}: "
-                        "reason(published)"
-                    )
-                    obj.delete()
 
 
 # Upate index per stack mirror
@@ -635,26 +902,39 @@ async def update_mirror_index(base_mirror_url):
     if check_skip_job():
         return
 
-    with helpers.temp_dir() as cwd:
-        git.clone(
-            "--branch",
-            helpers.pr_expected_base,
-            "--depth",
-            1,
-            helpers.spack_upstream,
-            "spack",
-        )
-        spack = sh.Command(f"{cwd}/spack/bin/spack")
-
-        for stack in list_ci_stacks(f"{cwd}/spack"):
-            stack_mirror_url = base_mirror_url.format_map({"stack": stack})
-            print(f"Updating binary index at {stack_mirror_url}")
-            helpers.run_command(
-                spack,
-                [
-                    "-d",
-                    "buildcache",
-                    "update-index",
-                    f"{stack_mirror_url}",
-                ],
+    with spack_base_clone() as spack_root:
+        spack = sh.Command(f"{spack_root}/bin/spack")
+
+        for stack in list_ci_stacks(spack_root):
+            update_stack_mirror_index(
+                spack, base_mirror_url.format_map({"stack": stack})
+            )
+
+
+# Prune and then reindex per stack mirror, sharing a single clone
+async def prune_and_reindex_mirror(shared_pr_mirror_url, publish_mirror_url):
+    """Prune the S3 mirror for shared PR binaries (see prune_mirror_duplicates),
+    then update its index (see update_mirror_index), fetching spack only once.
+
+        Parameters:
+            shared_pr_mirror_url (string): URL to S3 mirror for shared PR binaries
+            publish_mirror_url   (string): URL to S3 mirror for published PR binaries
+    """
+
+    # Current job stack
+    if check_skip_job():
+        return
+
+    s3 = boto3.resource("s3")
+
+    with spack_base_clone() as spack_root:
+        spack = sh.Command(f"{spack_root}/bin/spack")
+
+        for stack in list_ci_stacks(spack_root):
+            stack_mirror_url = shared_pr_mirror_url.format_map({"stack": stack})
+            prune_stack_mirror_duplicates(
+                s3,
+                stack_mirror_url,
+                publish_mirror_url.format_map({"stack": stack}),
             )
+            update_stack_mirror_index(spack, stack_mirror_url)